@@ -5,43 +5,160 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
+from pymongo.write_concern import WriteConcern
 from datetime import datetime, timezone
+import logging
 import os
 from dotenv import load_dotenv
-from typing import Union, Optional
+from typing import List, Union, Optional
 from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
 
-_client: Optional[MongoClient] = None
-db = None
+logger = logging.getLogger(__name__)
 
-def _connect():
-    """Lazy-connect to MongoDB using env vars if not already connected."""
+_client: Optional[AsyncIOMotorClient] = None
+db = None
+_indexes_built = False
+
+# (collection, keys, options) for every index the API's hot queries rely on
+INDEXES = [
+    ("adminuser", [("email", 1)], {"unique": True}),
+    ("casino", [("slug", 1)], {"unique": True}),
+    ("blogpost", [("slug", 1)], {"unique": True}),
+    ("offer", [("casino_slug", 1)], {}),
+    # Also serves the newest-first review slice on the casino detail page
+    ("review", [("casino_slug", 1), ("created_at", -1)], {}),
+    # Keyset pagination: equality filter first, then the sort key with _id as tiebreaker
+    ("casino", [("is_published", 1), ("name", 1), ("_id", 1)], {}),
+    ("casino", [("is_published", 1), ("base_score", 1), ("_id", 1)], {}),
+    ("blogpost", [("status", 1), ("published_at", 1), ("_id", 1)], {}),
+    # Casino search; MongoDB allows only one text index per collection
+    ("casino", [("name", "text"), ("bonus_text", "text")], {"name": "casino_text_idx"}),
+    # Equality (country) -> sort key -> _id tiebreak, one per sort key, matching the listing's
+    # {field, _id} sort in either direction so country listings never sort in memory. Their
+    # prefix also serves plain country filters.
+    ("casino", [("supported_countries", 1), ("base_score", -1), ("_id", -1)], {"name": "country_score_idx"}),
+    ("casino", [("supported_countries", 1), ("name", 1), ("_id", 1)], {"name": "country_name_idx"}),
+    # Case-insensitive prefix search runs as an anchored, case-sensitive regex on this field
+    ("casino", [("is_published", 1), ("name_lc", 1)], {}),
+    # Per-casino click reports, newest first
+    ("click", [("casino_slug", 1), ("_id", -1)], {}),
+]
+
+
+# Appended to aggregation pipelines so documents come back frontend-ready: the
+# ObjectId is rendered as a string `id` by the server and `_id` is dropped.
+STRINGIFY_ID_STAGES = [
+    {"$addFields": {"id": {"$toString": "$_id"}}},
+    {"$project": {"_id": 0}},
+]
+
+
+async def ensure_indexes(database):
+    """Create the indexes in INDEXES once per process.
+
+    Failures (e.g. duplicate slugs already in the data) are logged and skipped so
+    a bad index never takes the API down.
+    """
+    global _indexes_built
+    if _indexes_built:
+        return
+    for name, keys, options in INDEXES:
+        try:
+            await database[name].create_index(keys, **options)
+        except PyMongoError as e:
+            logger.warning("Could not create index %s on %s: %s", keys, name, e)
+    _indexes_built = True
+
+
+async def backfill_casino_name_lc(database):
+    """Store the lower-cased `name_lc` on casinos that don't have it yet.
+
+    Each update is guarded on the name it was computed from, so a concurrent rename (which
+    writes its own name_lc) is never overwritten. Safe to run on every startup.
+    """
+    async for c in database["casino"].find({"name_lc": {"$exists": False}}, {"name": 1}):
+        if isinstance(c.get("name"), str):
+            await database["casino"].update_one(
+                {"_id": c["_id"], "name": c["name"]}, {"$set": {"name_lc": c["name"].lower()}}
+            )
+
+
+async def migrate_casino_ratings(database):
+    """One-time migration: recompute every casino's `ratings: {breakdown, total, sum}` from `review`.
+
+    Casinos carry these counters, incremented as reviews are written; casinos that predate
+    them need this run once, with review writes stopped (e.g. before the first deploy that
+    increments them), since reviews written while it runs may be counted twice or not at all.
+    The whole recompute happens server-side in one pipeline, so it can also be rerun later to
+    reconcile drifted counters. Casinos without reviews get zeroed counters. Until a casino has
+    counters, the API counts its ratings from `review` on each detail read. For example:
+
+        python -c "import asyncio, database; asyncio.run(database.migrate_casino_ratings(database.connect()))"
+    """
+    await database["review"].aggregate([
+        {"$match": {"rating": {"$in": [1, 2, 3, 4, 5]}}},
+        {"$group": {"_id": {"slug": "$casino_slug", "rating": {"$toInt": "$rating"}}, "count": {"$sum": 1}}},
+        {"$group": {
+            "_id": "$_id.slug",
+            "breakdown": {"$push": {"k": {"$toString": "$_id.rating"}, "v": "$count"}},
+            "total": {"$sum": "$count"},
+            "sum": {"$sum": {"$multiply": ["$_id.rating", "$count"]}},
+        }},
+        {"$project": {
+            "_id": 0,
+            "slug": "$_id",
+            "ratings": {"breakdown": {"$arrayToObject": "$breakdown"}, "total": "$total", "sum": "$sum"},
+        }},
+        # Matches on the unique slug index; reviews of deleted casinos are discarded
+        {"$merge": {"into": "casino", "on": "slug", "whenMatched": "merge", "whenNotMatched": "discard"}},
+    ]).to_list(length=None)
+    await database["casino"].update_many(
+        {"ratings": {"$exists": False}}, {"$set": {"ratings": {"breakdown": {}, "total": 0, "sum": 0}}}
+    )
+
+
+def connect():
+    """Connect to MongoDB using env vars if not already connected.
+
+    Called once at app startup; the helpers below use the bound `db` directly.
+    Returns None if the env vars are not set.
+    """
     global _client, db
     if db is not None:
         return db
     database_url = os.getenv("DATABASE_URL")
     database_name = os.getenv("DATABASE_NAME")
     if database_url and database_name:
-        _client = MongoClient(database_url)
+        # Explicit pool sizing: the client is built once per process and reused, so
+        # connection setup stays off the request path and server RAM stays bounded.
+        _client = AsyncIOMotorClient(
+            database_url,
+            maxPoolSize=int(os.getenv("MONGO_MAX_POOL", "50")),
+            minPoolSize=int(os.getenv("MONGO_MIN_POOL", "5")),
+            maxIdleTimeMS=60_000,
+            serverSelectionTimeoutMS=5000,
+            retryWrites=True,
+        )
         db = _client[database_name]
         return db
     return None
 
 
 def get_db():
-    """Get a live db handle or None if env vars are not set."""
-    return _connect()
+    """Get the db handle bound by connect(), or None if not connected."""
+    return db
 
 
 # Helper functions for common database operations
 
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
-    database = _connect()
+    database = db
     if database is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
@@ -56,18 +173,51 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = now
     data_dict['updated_at'] = now
 
-    result = database[collection_name].insert_one(data_dict)
+    result = await database[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
-    database = _connect()
+async def create_documents_unacked(collection_name: str, items: List[Union[BaseModel, dict]]):
+    """Bulk-insert documents without waiting for the server to acknowledge them.
+
+    Timestamps already present on an item are kept, so callers that buffer writes can
+    stamp the time the event happened. Use only for writes where losing the occasional
+    document is acceptable (e.g. analytics).
+    """
+    database = db
     if database is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
-    cursor = database[collection_name].find(filter_dict or {})
-    if limit:
-        cursor = cursor.limit(limit)
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else dict(data)
+        data_dict.setdefault('created_at', now)
+        data_dict.setdefault('updated_at', data_dict['created_at'])
+        docs.append(data_dict)
+
+    col = database[collection_name].with_options(write_concern=WriteConcern(w=0))
+    await col.insert_many(docs, ordered=False)
 
-    return list(cursor)
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None, batch_size: int = 100,
+                        projection: dict = None):
+    """Get documents from collection, fetched from the server in batches of `batch_size`.
+
+    Documents carry a string `id` in place of `_id`. Pass `projection` to transfer
+    only the fields the caller uses.
+    """
+    database = db
+    if database is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    pipeline = [{"$match": filter_dict or {}}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    if projection:
+        pipeline.append({"$project": projection})
+    pipeline.extend(STRINGIFY_ID_STAGES)
+
+    # A bounded batch keeps each getMore small; with a limit, one batch covers the whole result
+    cursor = database[collection_name].aggregate(pipeline, batchSize=min(limit, batch_size) if limit else batch_size)
+    return await cursor.to_list(length=limit or None)
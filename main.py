@@ -1,22 +1,47 @@
+import asyncio
+import base64
+import hashlib
+import logging
 import os
-from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any, Literal
-
-from fastapi import FastAPI, Request, HTTPException, Depends, UploadFile, File
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Dict, Any, Literal, Tuple
+
+import orjson
+from bson import ObjectId, json_util
+from cachetools import TTLCache
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from pydantic import BaseModel
-from pymongo.collection import Collection
+from pydantic import BaseModel, Field
+from pymongo import ReturnDocument
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from database import (
+    STRINGIFY_ID_STAGES,
+    create_document,
+    create_documents_unacked,
+    connect,
+    get_db,
+    ensure_indexes,
+    backfill_casino_name_lc,
+)
+from schemas import Casino, Offer, Review, ReviewSubmission, Click, AdminUser, BlogPost, Media
 
-from database import create_document, get_documents, get_db
-from schemas import Casino, Offer, Review, Click, AdminUser, BlogPost, Media
+logger = logging.getLogger(__name__)
 
 # ----------------------------------------------------------------------------
 # App & CORS
 # ----------------------------------------------------------------------------
-app = FastAPI(title="Casino Affiliate API")
+# orjson serializes responses in C, several times faster than the stdlib json encoder
+app = FastAPI(title="Casino Affiliate API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,39 +51,167 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Public read endpoints that answer If-None-Match with 304 Not Modified
+ETAG_PATH_PREFIXES = ("/api/casinos", "/api/blogs")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or etag.removeprefix("W/") in candidates
+
+
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    response = await call_next(request)
+    if (
+        request.method != "GET"
+        or response.status_code != 200
+        or not request.url.path.startswith(ETAG_PATH_PREFIXES)
+        # Handlers that version their own responses have already answered If-None-Match
+        or "etag" in response.headers
+        # Streamed bodies are sent as they are produced; hashing would buffer them whole
+        or response.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE)
+    ):
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    # Weak because the body may be gzip-encoded on the way out
+    etag = f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    headers = dict(response.headers)
+    headers["ETag"] = etag
+    return Response(content=body, status_code=response.status_code, headers=headers, media_type=response.media_type)
+
+
+# Listing responses may be reused by browsers and shared caches for a minute
+LISTING_CACHE_CONTROL = "public, max-age=60"
+
+# Added last so it is the outermost layer and compresses the final body. Bodies that
+# already fit in one packet (~1500 B MTU) gain nothing from compression.
+app.add_middleware(GZipMiddleware, minimum_size=1500)
+
 # ----------------------------------------------------------------------------
 # Config & Security
 # ----------------------------------------------------------------------------
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change")
 JWT_ALG = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE", "60"))
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Reject tokens missing exp/sub inside jose rather than after a full decode
+JWT_DECODE_OPTIONS = {"require_exp": True, "require_sub": True}
+
+# bcrypt cost is 2^rounds: each step down halves login CPU but also halves an attacker's
+# per-guess cost. 10 is the OWASP floor; raise BCRYPT_ROUNDS where login volume allows.
+# Hashes made at any other cost count as deprecated and are rehashed on the next login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+    # Pinned so passlib never has to pick an ident at runtime
+    bcrypt__ident="2b",
+    deprecated="auto",
+)
+# Verified against when a login email is unknown, so both branches cost one bcrypt round.
+# Hashing it at import also loads and self-tests the bcrypt backend, so that one-time
+# cost is paid at boot rather than by the first login.
+_DUMMY_HASH = pwd_context.hash("dummy-password")
 # Keep OAuth2 scheme for compatibility with clients that send a Bearer token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
+# Verified bearer tokens -> (user, exp). Keyed by a digest so raw tokens are never held in memory.
+TOKEN_CACHE_TTL = 60
+_token_cache: TTLCache = TTLCache(maxsize=4096, ttl=TOKEN_CACHE_TTL)
+_token_cache_lock = threading.Lock()
+
 # ----------------------------------------------------------------------------
 # Helpers
 # ----------------------------------------------------------------------------
 
-def collection(name: str) -> Collection:
+def collection(name: str) -> AsyncIOMotorCollection:
     database = get_db()
     if database is None:
         raise HTTPException(status_code=503, detail="Database not initialized")
     return database[name]
 
 
-def verify_password(plain_password: str, password_hash: str) -> bool:
+def verify_password(plain_password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    """Return (matches, new_hash); new_hash is set when a matching hash should be replaced."""
     try:
-        return pwd_context.verify(plain_password, password_hash)
+        return pwd_context.verify_and_update(plain_password, password_hash)
     except Exception:
-        return False
+        return False, None
 
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+# Sort key types a page cursor may carry (names, scores, publish dates)
+CURSOR_VALUE_TYPES = (str, int, float, datetime, type(None))
+
+
+def encode_cursor(value: Any, _id: Any) -> str:
+    """Serialize the last-seen (sort value, _id) pair into an opaque page cursor."""
+    return base64.urlsafe_b64encode(json_util.dumps([value, _id]).encode()).decode()
+
+
+def keyset_filter(cursor: str, field: str, direction: int) -> Dict[str, Any]:
+    """Build the filter selecting documents after `cursor` in (field, _id) order."""
+    try:
+        value, last_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # The cursor is client-controlled: only plain scalars may reach the query, never
+    # operator documents or regexes that json_util would happily decode
+    if (
+        not isinstance(last_id, ObjectId)
+        or isinstance(value, bool)
+        or not isinstance(value, CURSOR_VALUE_TYPES)
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    op = "$gt" if direction == 1 else "$lt"
+    return {"$or": [{field: {op: value}}, {field: value, "_id": {op: last_id}}]}
+
+
+async def touch_casino(slug: str):
+    """Bump a casino's updated_at after a write that changes its detail page (offers, reviews)."""
+    await collection("casino").update_one({"slug": slug}, {"$set": {"updated_at": datetime.now(timezone.utc)}})
+
+
+def casino_etag(updated_at: datetime, include_seo: bool) -> str:
+    return f'W/"casino-{updated_at:%Y%m%d%H%M%S%f}-{int(include_seo)}"'
+
+
+async def fetch_page(col: AsyncIOMotorCollection, filter_q: Dict[str, Any], page_stages: List[Dict[str, Any]],
+                     with_total: bool):
+    """Run `page_stages` over the documents matching `filter_q`; returns (docs, total).
+
+    With `with_total`, the match count comes from the same aggregation via $facet, so the
+    filter is evaluated once and the page costs a single round-trip. Otherwise total is None.
+    """
+    if not with_total:
+        docs = await col.aggregate([{"$match": filter_q}, *page_stages]).to_list(length=None)
+        return docs, None
+    pipeline = [
+        # $match stays first so the planner can use an index for it
+        {"$match": filter_q},
+        {"$facet": {"items": page_stages, "total": [{"$count": "n"}]}},
+    ]
+    facet = (await col.aggregate(pipeline).to_list(length=1))[0]
+    return facet["items"], facet["total"][0]["n"] if facet["total"] else 0
+
+
+async def stream_ndjson(cursor):
+    """Yield each document of a Motor cursor as one NDJSON line, encoded as it arrives."""
+    async for doc in cursor:
+        yield orjson.dumps(doc) + b"\n"
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -71,19 +224,33 @@ class TokenResponse(BaseModel):
     token_type: str = "bearer"
 
 
+AUTH_USER_PROJECTION = {"email": 1, "role": 1, "is_active": 1}
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    # The cache TTL is global, so the token's own exp is re-checked on every hit
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG], options=JWT_DECODE_OPTIONS)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = collection("adminuser").find_one({"email": email})
+    # Only the fields authorization needs; notably the password hash never leaves the DB here
+    user = await collection("adminuser").find_one({"email": email}, projection=AUTH_USER_PROJECTION)
     if not user or not user.get("is_active", True):
         raise credentials_exception
     user["id"] = str(user.pop("_id", ""))
+    exp = payload.get("exp")
+    if exp is not None:
+        with _token_cache_lock:
+            _token_cache[cache_key] = (user, exp)
     return user
 
 
@@ -95,6 +262,25 @@ def require_roles(*roles: str):
     return role_checker
 
 
+# Built once so every route shares the same dependency callables. Dependencies are solved
+# before the request body is validated, so unauthorized writes never build a payload model.
+require_editor = require_roles("admin", "editor")
+require_moderator = require_roles("admin", "reviewer", "editor")
+
+
+# ----------------------------------------------------------------------------
+# Lifecycle
+# ----------------------------------------------------------------------------
+@app.on_event("startup")
+async def connect_database():
+    # Fail fast: a misconfigured deployment should not come up and serve empty listings
+    database = connect()
+    if database is None:
+        raise RuntimeError("Database not configured. Set DATABASE_URL and DATABASE_NAME.")
+    await ensure_indexes(database)
+    await backfill_casino_name_lc(database)
+
+
 # ----------------------------------------------------------------------------
 # Health
 # ----------------------------------------------------------------------------
@@ -103,13 +289,26 @@ async def read_root():
     return {"message": "Casino Affiliate Backend Running"}
 
 
+# Collection names barely change, so uptime checks hitting /test reuse them between refreshes
+HEALTHCHECK_CACHE_TTL = int(os.getenv("HEALTHCHECK_CACHE_TTL", "30"))
+_collection_names_cache: TTLCache = TTLCache(maxsize=1, ttl=HEALTHCHECK_CACHE_TTL)
+
+
+async def _collection_names(database) -> List[str]:
+    names = _collection_names_cache.get(database.name)
+    if names is None:
+        names = await database.list_collection_names()
+        _collection_names_cache[database.name] = names
+    return names
+
+
 @app.get("/test")
 async def test_database():
     try:
         database = get_db()
         if database is None:
             raise Exception("Database not initialized")
-        collections = database.list_collection_names()
+        collections = await _collection_names(database)
         return {
             "backend": "✅ Running",
             "database": "✅ Connected & Working",
@@ -141,16 +340,16 @@ async def register(payload: RegisterPayload):
         # Allow registration without DB by returning a clear error
         raise HTTPException(status_code=503, detail="Database not initialized")
     col = database["adminuser"]
-    if col.find_one({"email": payload.email}):
+    if await col.find_one({"email": payload.email}):
         raise HTTPException(status_code=400, detail="Email already registered")
     doc = {
         "email": payload.email,
-        "password_hash": get_password_hash(payload.password),
+        "password_hash": await run_in_threadpool(get_password_hash, payload.password),
         "role": "admin",
         "is_active": True,
         "created_at": datetime.utcnow(),
     }
-    res = col.insert_one(doc)
+    res = await col.insert_one(doc)
     return {"id": str(res.inserted_id), "email": payload.email}
 
 
@@ -185,9 +384,22 @@ async def login(request: Request):
     if database is None:
         raise HTTPException(status_code=503, detail="Database not initialized")
 
-    user = database["adminuser"].find_one({"email": email})
-    if not user or not verify_password(password, user.get("password_hash", "")):
+    user = await database["adminuser"].find_one({"email": email})
+    # Always pay for one bcrypt verify so unknown emails can't be told apart by response time.
+    # bcrypt is pure CPU, so it runs in the threadpool to keep the event loop free.
+    password_hash = user.get("password_hash") if user else None
+    password_ok, new_hash = await run_in_threadpool(verify_password, password, password_hash or _DUMMY_HASH)
+    # The dummy hash only equalizes timing; it must never authenticate a hashless account
+    if not password_hash:
+        password_ok = False
+    if not user or not password_ok:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # Rehash at BCRYPT_ROUNDS so every account converges on the dummy hash's cost;
+        # until then a wrong password on that account is slower than an unknown email
+        await database["adminuser"].update_one(
+            {"_id": user["_id"], "password_hash": password_hash}, {"$set": {"password_hash": new_hash}}
+        )
 
     token = create_access_token({"sub": user["email"], "role": user.get("role", "admin")})
     return TokenResponse(access_token=token)
@@ -197,56 +409,143 @@ async def login(request: Request):
 # Public content endpoints
 # ----------------------------------------------------------------------------
 
+# Fields the listing cards render; heavy arrays (gallery, pros/cons, providers...) stay on the detail page
+LIST_PROJECTION = {
+    "name": 1,
+    "slug": 1,
+    "logo_url": 1,
+    "affiliate_url": 1,
+    "base_score": 1,
+    "bonus_text": 1,
+    "features": 1,
+    "supported_countries": 1,
+}
+
+
+# `sort` query values -> (field, direction); unknown values fall back to name_asc
+SORT_SPECS = {
+    "score_desc": ("base_score", -1),
+    "score_asc": ("base_score", 1),
+    "name_desc": ("name", -1),
+    "name_asc": ("name", 1),
+}
+
+# Listing responses keyed by normalized query params. Admin casino writes clear it; the TTL
+# bounds staleness for writes handled by other worker processes.
+_casino_list_cache: TTLCache = TTLCache(maxsize=512, ttl=60)
+
+
 @app.get("/api/casinos")
 async def list_casinos(
+    request: Request,
+    response: Response,
     country: Optional[str] = None,
     q: Optional[str] = None,
     page: int = 1,
     page_size: int = 10,
     sort: Optional[str] = None,
+    cursor: Optional[str] = None,
+    match: Optional[Literal["prefix", "contains"]] = None,
 ):
-    """Return published casinos. If database is not configured, return an empty list instead of failing.
+    """Return published casinos. If the database query fails, return an empty list instead of failing.
+
+    Pass the `next_cursor` of a previous response as `cursor` to page by keyset instead of
+    by offset; cursor pages skip the total count and report only `has_more`.
+    A search (`q`) without an explicit `sort` is ranked by text relevance and pages by offset only.
+    Set `match` to search the name by prefix or substring instead of by text index.
+    Clients sending `Accept: application/x-ndjson` get the page's items streamed one per line,
+    without pagination metadata.
     """
-    try:
-        if page < 1:
-            page = 1
-        if page_size < 1 or page_size > 50:
-            page_size = 10
-
-        filter_q: Dict[str, Any] = {"is_published": True}
-        if country:
-            filter_q["supported_countries"] = {"$in": [country.upper()]}
-        if q:
-            filter_q["name"] = {"$regex": q, "$options": "i"}
-
-        sort_spec = None
-        if sort == "score_desc":
-            sort_spec = ("base_score", -1)
-        elif sort == "score_asc":
-            sort_spec = ("base_score", 1)
-        elif sort == "name_desc":
-            sort_spec = ("name", -1)
-        else:
-            sort_spec = ("name", 1)
+    if page < 1:
+        page = 1
+    if page_size < 1 or page_size > 50:
+        page_size = 10
 
-        col = collection("casino")
-        total = col.count_documents(filter_q)
-        cursor = col.find(filter_q).sort([sort_spec]).skip((page - 1) * page_size).limit(page_size)
-        docs = list(cursor)
-        for d in docs:
-            d["id"] = str(d.pop("_id", ""))
+    sort_field, sort_dir = SORT_SPECS.get(sort, SORT_SPECS["name_asc"])
+    rank_by_relevance = bool(q) and match is None and sort is None and not cursor
+
+    filter_q: Dict[str, Any] = {"is_published": True}
+    if country:
+        filter_q["supported_countries"] = {"$in": [country.upper()]}
+    if q and match == "prefix":
+        # Case-sensitive, escaped and anchored against the lower-cased name, so the planner
+        # bounds the scan to one range of the name_lc index ("i" would force a full index scan)
+        filter_q["name_lc"] = {"$regex": f"^{re.escape(q.lower())}"}
+    elif q and match == "contains":
+        filter_q["name"] = {"$regex": re.escape(q), "$options": "i"}
+    elif q:
+        # Served by the name/bonus_text text index; also immune to regex injection/ReDoS from user input
+        filter_q["$text"] = {"$search": q}
+    if cursor:
+        filter_q.update(keyset_filter(cursor, sort_field, sort_dir))
+
+    if rank_by_relevance:
+        sort_stage = {"$sort": {"score": {"$meta": "textScore"}, "_id": 1}}
+    else:
+        sort_stage = {"$sort": {sort_field: sort_dir, "_id": sort_dir}}
+    skip_stages = [] if cursor else [{"$skip": (page - 1) * page_size}]
+    # Both representations share the URL, so shared caches must key on Accept too
+    response.headers["Vary"] = "Accept"
+
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        pipeline = [
+            {"$match": filter_q},
+            sort_stage,
+            *skip_stages,
+            {"$limit": page_size},
+            {"$project": LIST_PROJECTION},
+            *STRINGIFY_ID_STAGES,
+        ]
+        # Documents are encoded and sent batch by batch instead of materializing the page
+        rows = collection("casino").aggregate(pipeline, batchSize=page_size)
+        return StreamingResponse(stream_ndjson(rows), media_type=NDJSON_MEDIA_TYPE, headers={"Vary": "Accept"})
+
+    cache_key = (country.upper() if country else None, q, match, sort, cursor, None if cursor else page, page_size)
+    cached = _casino_list_cache.get(cache_key)
+    if cached is not None:
+        response.headers["Cache-Control"] = LISTING_CACHE_CONTROL
+        return cached
 
-        return {
-            "items": docs,
-            "pagination": {
-                "page": page,
-                "page_size": page_size,
-                "total": total,
-                "pages": (total + page_size - 1) // page_size,
-            },
-        }
+    try:
+        col = collection("casino")
+        page_stages = [
+            sort_stage,
+            *skip_stages,
+            {"$limit": page_size + 1},
+            {"$project": LIST_PROJECTION},
+            *STRINGIFY_ID_STAGES,
+        ]
+        # Cursor pages don't report a total, so they skip counting altogether
+        docs, total = await fetch_page(col, filter_q, page_stages, with_total=not cursor)
+        has_more = len(docs) > page_size
+        docs = docs[:page_size]
+        next_cursor = (
+            encode_cursor(docs[-1].get(sort_field), ObjectId(docs[-1]["id"]))
+            if has_more and not rank_by_relevance else None
+        )
+
+        if cursor:
+            result = {
+                "items": docs,
+                "pagination": {"page_size": page_size, "has_more": has_more, "next_cursor": next_cursor},
+            }
+        else:
+            result = {
+                "items": docs,
+                "pagination": {
+                    "page": page,
+                    "page_size": page_size,
+                    "total": total,
+                    "pages": (total + page_size - 1) // page_size,
+                    "has_more": has_more,
+                    "next_cursor": next_cursor,
+                },
+            }
+        _casino_list_cache[cache_key] = result
+        response.headers["Cache-Control"] = LISTING_CACHE_CONTROL
+        return result
     except Exception:
-        # Graceful fallback when DB isn't configured
+        # Graceful fallback when the database is unreachable
         return {
             "items": [],
             "pagination": {
@@ -254,39 +553,86 @@ async def list_casinos(
                 "page_size": page_size,
                 "total": 0,
                 "pages": 0,
+                "has_more": False,
+                "next_cursor": None,
             },
         }
 
 
+# Most recent reviews embedded in the casino detail response
+CASINO_REVIEWS_LIMIT = 20
+
+
 @app.get("/api/casinos/{slug}")
-async def get_casino(slug: str):
+async def get_casino(request: Request, response: Response, slug: str, include_seo: bool = False):
+    """Casino detail with offers, latest reviews and ratings. `seo_description` is only sent with include_seo.
+
+    The ETag is derived from the casino's updated_at, which every write affecting this page
+    bumps, so a revalidation costs one indexed point read instead of the full aggregation.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        head = await collection("casino").find_one({"slug": slug}, {"updated_at": 1})
+        if head and head.get("updated_at"):
+            etag = casino_etag(head["updated_at"], include_seo)
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+
+    pipeline = [
+        {"$match": {"slug": slug}},
+        {"$limit": 1},
+        # Offers and the newest reviews are joined server-side; casino_slug is dropped from
+        # both since it repeats the casino's own slug
+        {"$lookup": {
+            "from": "offer",
+            "let": {"slug": "$slug"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$casino_slug", "$$slug"]}}},
+                {"$project": {"casino_slug": 0}},
+                *STRINGIFY_ID_STAGES,
+            ],
+            "as": "offers",
+        }},
+        {"$lookup": {
+            "from": "review",
+            "let": {"slug": "$slug"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$casino_slug", "$$slug"]}}},
+                {"$sort": {"created_at": -1}},
+                {"$limit": CASINO_REVIEWS_LIMIT},
+                {"$project": {"casino_slug": 0, "moderation_notes": 0}},
+                *STRINGIFY_ID_STAGES,
+            ],
+            "as": "reviews",
+        }},
+        *STRINGIFY_ID_STAGES,
+    ]
+    # name_lc only exists to serve prefix search
+    hidden_fields = {"name_lc": 0} if include_seo else {"name_lc": 0, "seo_description": 0}
+    pipeline.insert(2, {"$project": hidden_fields})
     try:
-        docs = get_documents("casino", {"slug": slug})
+        docs = await collection("casino").aggregate(pipeline).to_list(length=1)
     except Exception:
         raise HTTPException(status_code=404, detail="Casino not found")
     if not docs:
         raise HTTPException(status_code=404, detail="Casino not found")
     d = docs[0]
-    d["id"] = str(d.pop("_id", ""))
-    offers = get_documents("offer", {"casino_slug": slug})
-    for o in offers:
-        o["id"] = str(o.pop("_id", ""))
-    reviews = get_documents("review", {"casino_slug": slug})
-    for r in reviews:
-        r["id"] = str(r.pop("_id", ""))
+    offers = d.pop("offers")
+    reviews = d.pop("reviews")
+    # Rating counters are maintained on the casino by the review write paths; casinos
+    # that predate them are counted from their reviews until migrate_casino_ratings runs
+    stored_ratings = d.pop("ratings", None)
+    if stored_ratings is None:
+        stored_ratings = await count_casino_ratings(slug)
+    if d.get("updated_at"):
+        response.headers["ETag"] = casino_etag(d["updated_at"], include_seo)
 
     breakdown = {str(i): 0 for i in range(1, 6)}
-    for r in reviews:
-        try:
-            breakdown[str(int(r.get("rating", 0)))] += 1
-        except Exception:
-            pass
+    for rating, count in (stored_ratings.get("breakdown") or {}).items():
+        if rating in breakdown:
+            breakdown[rating] = count
     total_reviews = sum(breakdown.values())
-    avg_rating = (
-        round(
-            sum(int(k) * v for k, v in breakdown.items()) / total_reviews, 2
-        ) if total_reviews else None
-    )
+    avg_rating = round(stored_ratings.get("sum", 0) / total_reviews, 2) if total_reviews else None
 
     return {
         "casino": d,
@@ -300,110 +646,190 @@ async def get_casino(slug: str):
     }
 
 
-class NewReview(BaseModel):
-    casino_slug: str
-    user_name: str
-    rating: int
-    comment: Optional[str] = None
+async def count_casino_ratings(slug: str) -> Dict[str, Any]:
+    """Compute a casino's rating counters from its reviews, in the stored `ratings` shape."""
+    buckets = collection("review").aggregate([
+        {"$match": {"casino_slug": slug, "rating": {"$in": [1, 2, 3, 4, 5]}}},
+        {"$group": {"_id": {"$toInt": "$rating"}, "count": {"$sum": 1}}},
+    ])
+    ratings = {"breakdown": {}, "total": 0, "sum": 0}
+    async for bucket in buckets:
+        ratings["breakdown"][str(bucket["_id"])] = bucket["count"]
+        ratings["total"] += bucket["count"]
+        ratings["sum"] += bucket["_id"] * bucket["count"]
+    return ratings
 
 
 @app.post("/api/reviews")
-async def submit_review(payload: NewReview):
-    review = Review(**payload.model_dump())
-    inserted_id = create_document("review", review)
+async def submit_review(payload: ReviewSubmission):
+    # Review only adds defaulted moderation fields to ReviewSubmission, whose constraints it
+    # inherits, so the validated payload needs no second validation pass
+    review = Review.model_construct(**payload.model_dump())
+    inserted_id = await create_document("review", review)
+    # Counters are only incremented where they exist; creating them here would hide the
+    # casino's earlier reviews from the read-side fallback
+    res = await collection("casino").update_one(
+        {"slug": payload.casino_slug, "ratings": {"$exists": True}},
+        {
+            "$inc": {
+                f"ratings.breakdown.{payload.rating}": 1,
+                "ratings.total": 1,
+                "ratings.sum": payload.rating,
+            },
+            "$set": {"updated_at": datetime.now(timezone.utc)},
+        },
+    )
+    if res.matched_count == 0:
+        await touch_casino(payload.casino_slug)
     return {"id": inserted_id, "message": "Review submitted"}
 
 
-class NewOffer(BaseModel):
-    casino_slug: str
-    title: str
-    description: Optional[str] = None
-    bonus_amount: Optional[str] = None
-    wagering: Optional[str] = None
-    code: Optional[str] = None
-
-
 @app.post("/api/offers")
-async def create_offer(payload: NewOffer, user=Depends(require_roles("admin", "editor"))):
+async def create_offer(payload: Offer, user=Depends(require_editor)):
     # Now strictly role-based auth
-    casino_docs = get_documents("casino", {"slug": payload.casino_slug})
-    if not casino_docs:
+    # Projecting only the indexed slug makes this a covered query: no document is fetched
+    casino = await collection("casino").find_one({"slug": payload.casino_slug}, {"_id": 0, "slug": 1})
+    if casino is None:
         raise HTTPException(status_code=400, detail="Casino does not exist")
-    offer = Offer(**payload.model_dump())
-    inserted_id = create_document("offer", offer)
+    inserted_id = await create_document("offer", payload)
+    await touch_casino(payload.casino_slug)
     return {"id": inserted_id, "message": "Offer created"}
 
 
+# Clicks are buffered in-process and bulk-inserted by a background task, so the
+# endpoint never waits on Mongo and the database sees one insert_many per tick.
+# A full batch triggers an early flush; a full queue (e.g. Mongo down) sheds new clicks.
+CLICK_FLUSH_INTERVAL = int(os.getenv("CLICK_FLUSH_INTERVAL_MS", "100")) / 1000
+CLICK_BATCH_SIZE = int(os.getenv("CLICK_BATCH_SIZE", "500"))
+CLICK_QUEUE_MAX = int(os.getenv("CLICK_QUEUE_MAX", "50000"))
+
+_click_queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=CLICK_QUEUE_MAX)
+_click_batch_ready = asyncio.Event()
+_click_flusher_stop = asyncio.Event()
+_click_flusher_task: Optional[asyncio.Task] = None
+
+
+async def _flush_clicks():
+    while not _click_queue.empty():
+        batch = []
+        while len(batch) < CLICK_BATCH_SIZE and not _click_queue.empty():
+            batch.append(_click_queue.get_nowait())
+        try:
+            await create_documents_unacked("click", batch)
+        except Exception as e:
+            logger.warning("Dropped %d click events: %s", len(batch), e)
+
+
+async def _click_flusher():
+    while not _click_flusher_stop.is_set():
+        try:
+            await asyncio.wait_for(_click_batch_ready.wait(), CLICK_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _click_batch_ready.clear()
+        await _flush_clicks()
+
+
+@app.on_event("startup")
+async def start_click_flusher():
+    global _click_flusher_task
+    _click_flusher_task = asyncio.create_task(_click_flusher())
+
+
+@app.on_event("shutdown")
+async def stop_click_flusher():
+    # Let the flusher finish the batch it may be inserting rather than cancelling it mid-write
+    _click_flusher_stop.set()
+    _click_batch_ready.set()
+    if _click_flusher_task is not None:
+        await _click_flusher_task
+    await _flush_clicks()
+
+
 @app.post("/api/click")
 async def track_click(payload: Click, request: Request):
     data = payload.model_dump()
     data["user_agent"] = request.headers.get("user-agent")
     data["ip"] = request.client.host if request.client else None
+    # Assign the id up front so it can be returned before the buffered insert runs
+    data["_id"] = ObjectId()
+    data["created_at"] = datetime.now(timezone.utc)
     try:
-        inserted_id = create_document("click", data)
-        return {"id": inserted_id, "status": "ok"}
-    except Exception:
-        # If DB isn't available, still acknowledge the click
+        _click_queue.put_nowait(data)
+    except asyncio.QueueFull:
+        logger.warning("Click buffer full, dropping click for %s", payload.casino_slug)
         return {"id": None, "status": "ok"}
+    if _click_queue.qsize() >= CLICK_BATCH_SIZE:
+        _click_batch_ready.set()
+    return {"id": str(data["_id"]), "status": "ok"}
 
 
 # ----------------------------------------------------------------------------
 # Admin-secured CRUD endpoints
 # ----------------------------------------------------------------------------
 
-class CasinoUpsert(BaseModel):
-    name: str
-    slug: str
-    affiliate_url: str
-    logo_url: Optional[str] = None
-    bonus_text: Optional[str] = None
-    features: Optional[List[str]] = []
-    supported_countries: Optional[List[str]] = []
-    base_score: Optional[float] = 4.0
-    pros: Optional[List[str]] = []
-    cons: Optional[List[str]] = []
-    payment_methods: Optional[List[str]] = []
-    providers: Optional[List[str]] = []
-    gallery: Optional[List[str]] = []
-    seo_title: Optional[str] = None
-    seo_description: Optional[str] = None
-    is_published: Optional[bool] = True
-
-
-@app.post("/api/admin/casinos", dependencies=[Depends(require_roles("admin", "editor"))])
-async def admin_create_casino(payload: CasinoUpsert):
-    if collection("casino").find_one({"slug": payload.slug}):
+# Casino admin endpoints take the storage schema directly, so the body is validated once
+@app.post("/api/admin/casinos", dependencies=[Depends(require_editor)])
+async def admin_create_casino(payload: Casino):
+    if await collection("casino").find_one({"slug": payload.slug}):
         raise HTTPException(status_code=400, detail="Slug already exists")
-    doc = Casino(**payload.model_dump())
-    inserted_id = create_document("casino", doc)
+    doc = {**payload.model_dump(), "name_lc": payload.name.lower(), "ratings": {"breakdown": {}, "total": 0, "sum": 0}}
+    inserted_id = await create_document("casino", doc)
+    _casino_list_cache.clear()
     return {"id": inserted_id}
 
 
-@app.put("/api/admin/casinos/{slug}", dependencies=[Depends(require_roles("admin", "editor"))])
-async def admin_update_casino(slug: str, payload: CasinoUpsert):
-    res = collection("casino").update_one({"slug": slug}, {"$set": payload.model_dump()})
+@app.put("/api/admin/casinos/{slug}", dependencies=[Depends(require_editor)])
+async def admin_update_casino(slug: str, payload: Casino):
+    doc = payload.model_dump()
+    doc["name_lc"] = payload.name.lower()
+    doc["updated_at"] = datetime.now(timezone.utc)
+    res = await collection("casino").update_one({"slug": slug}, {"$set": doc})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Casino not found")
+    _casino_list_cache.clear()
     return {"updated": True}
 
 
 class ReviewUpdate(BaseModel):
-    rating: Optional[int] = None
+    rating: Optional[int] = Field(None, ge=1, le=5)
     comment: Optional[str] = None
     status: Optional[Literal["pending", "approved", "rejected"]] = None
     moderation_notes: Optional[str] = None
 
 
-@app.put("/api/admin/reviews/{review_id}", dependencies=[Depends(require_roles("admin", "reviewer", "editor"))])
+@app.put("/api/admin/reviews/{review_id}", dependencies=[Depends(require_moderator)])
 async def admin_update_review(review_id: str, payload: ReviewUpdate):
-    from bson import ObjectId
     try:
         _id = ObjectId(review_id)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid review id")
-    res = collection("review").update_one({"_id": _id}, {"$set": {k: v for k, v in payload.model_dump().items() if v is not None}})
-    if res.matched_count == 0:
+    # The pre-update rating is needed to move the casino's rating counters
+    review = await collection("review").find_one_and_update(
+        {"_id": _id},
+        {"$set": {k: v for k, v in payload.model_dump().items() if v is not None}},
+        projection={"casino_slug": 1, "rating": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if review is None:
         raise HTTPException(status_code=404, detail="Review not found")
+    old_rating = review.get("rating")
+    moved = False
+    if payload.rating is not None and old_rating is not None and payload.rating != old_rating:
+        res = await collection("casino").update_one(
+            {"slug": review["casino_slug"], "ratings": {"$exists": True}},
+            {
+                "$inc": {
+                    f"ratings.breakdown.{old_rating}": -1,
+                    f"ratings.breakdown.{payload.rating}": 1,
+                    "ratings.sum": payload.rating - old_rating,
+                },
+                "$set": {"updated_at": datetime.now(timezone.utc)},
+            },
+        )
+        moved = res.matched_count > 0
+    if not moved:
+        await touch_casino(review["casino_slug"])
     return {"updated": True}
 
 
@@ -421,29 +847,31 @@ class BlogUpsert(BaseModel):
     seo_description: Optional[str] = None
 
 
-@app.post("/api/admin/blogs", dependencies=[Depends(require_roles("admin", "editor"))])
-async def admin_create_blog(payload: BlogUpsert, user=Depends(get_current_user)):
-    if collection("blogpost").find_one({"slug": payload.slug}):
+@app.post("/api/admin/blogs")
+async def admin_create_blog(payload: BlogUpsert, user=Depends(require_editor)):
+    if await collection("blogpost").find_one({"slug": payload.slug}):
         raise HTTPException(status_code=400, detail="Slug already exists")
     doc = payload.model_dump()
     if doc.get("status") == "published" and not doc.get("published_at"):
         doc["published_at"] = datetime.utcnow()
     doc["author_email"] = user.get("email")
-    res = collection("blogpost").insert_one(doc)
+    res = await collection("blogpost").insert_one(doc)
     return {"id": str(res.inserted_id)}
 
 
-@app.put("/api/admin/blogs/{slug}", dependencies=[Depends(require_roles("admin", "editor"))])
+@app.put("/api/admin/blogs/{slug}", dependencies=[Depends(require_editor)])
 async def admin_update_blog(slug: str, payload: BlogUpsert):
     doc = payload.model_dump()
-    res = collection("blogpost").update_one({"slug": slug}, {"$set": doc})
+    res = await collection("blogpost").update_one({"slug": slug}, {"$set": doc})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Blog not found")
     return {"updated": True}
 
 
 @app.get("/api/blogs")
-async def list_blogs(page: int = 1, page_size: int = 10, tag: Optional[str] = None):
+async def list_blogs(response: Response, page: int = 1, page_size: int = 10, tag: Optional[str] = None,
+                     cursor: Optional[str] = None):
+    response.headers["Cache-Control"] = LISTING_CACHE_CONTROL
     if page < 1:
         page = 1
     if page_size < 1 or page_size > 50:
@@ -451,20 +879,35 @@ async def list_blogs(page: int = 1, page_size: int = 10, tag: Optional[str] = No
     q: Dict[str, Any] = {"status": "published"}
     if tag:
         q["tags"] = {"$in": [tag]}
+    if cursor:
+        q.update(keyset_filter(cursor, "published_at", -1))
     col = collection("blogpost")
-    total = col.count_documents(q)
-    docs = list(col.find(q).sort([("published_at", -1)]).skip((page - 1) * page_size).limit(page_size))
-    for d in docs:
-        d["id"] = str(d.pop("_id", ""))
+    page_stages = [{"$sort": {"published_at": -1, "_id": -1}}]
+    if not cursor:
+        page_stages.append({"$skip": (page - 1) * page_size})
+    page_stages.append({"$limit": page_size + 1})
+    # Listings don't render the post body, which is by far the largest field
+    page_stages.append({"$project": {"content": 0}})
+    page_stages.extend(STRINGIFY_ID_STAGES)
+    docs, total = await fetch_page(col, q, page_stages, with_total=not cursor)
+    has_more = len(docs) > page_size
+    docs = docs[:page_size]
+    next_cursor = encode_cursor(docs[-1].get("published_at"), ObjectId(docs[-1]["id"])) if has_more else None
+    if cursor:
+        return {
+            "items": docs,
+            "pagination": {"page_size": page_size, "has_more": has_more, "next_cursor": next_cursor}
+        }
     return {
         "items": docs,
-        "pagination": {"page": page, "page_size": page_size, "total": total, "pages": (total + page_size - 1)//page_size}
+        "pagination": {"page": page, "page_size": page_size, "total": total, "pages": (total + page_size - 1)//page_size,
+                       "has_more": has_more, "next_cursor": next_cursor}
     }
 
 
 @app.get("/api/blogs/{slug}")
 async def get_blog(slug: str):
-    doc = collection("blogpost").find_one({"slug": slug, "status": "published"})
+    doc = await collection("blogpost").find_one({"slug": slug, "status": "published"})
     if not doc:
         raise HTTPException(status_code=404, detail="Not found")
     doc["id"] = str(doc.pop("_id", ""))
@@ -475,7 +918,7 @@ async def get_blog(slug: str):
 # Media handling (basic, URL-based or GridFS placeholder)
 # ----------------------------------------------------------------------------
 
-@app.post("/api/admin/media", dependencies=[Depends(require_roles("admin", "editor"))])
+@app.post("/api/admin/media", dependencies=[Depends(require_editor)])
 async def upload_media(file: UploadFile = File(...)):
     content = await file.read()
     size = len(content)
@@ -486,7 +929,7 @@ async def upload_media(file: UploadFile = File(...)):
         "storage": "gridfs",
         "created_at": datetime.utcnow(),
     }
-    res = collection("media").insert_one(doc)
+    res = await collection("media").insert_one(doc)
     return {"id": str(res.inserted_id), "filename": file.filename, "size": size}
 
 
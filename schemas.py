@@ -71,12 +71,15 @@ class Offer(BaseModel):
     wagering: Optional[str] = None
     code: Optional[str] = None
 
-class Review(BaseModel):
-    """User-submitted reviews for a casino"""
+class ReviewSubmission(BaseModel):
+    """Review fields a visitor may submit; Review adds moderation state"""
     casino_slug: str
     user_name: str
     rating: int = Field(..., ge=1, le=5)
     comment: Optional[str] = None
+
+class Review(ReviewSubmission):
+    """User-submitted reviews for a casino"""
     status: Literal["pending", "approved", "rejected"] = Field("approved")
     moderation_notes: Optional[str] = None
 